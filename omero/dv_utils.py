@@ -16,12 +16,89 @@
 ## You should have received a copy of the GNU Affero General Public License
 ## along with this program; if not, see <http://www.gnu.org/licenses/>.
 
-import os.path
 import struct
 
 import omero_scripts_processing
 import numpy
 
+## Bytes at position 96 of the header.  DV files can have either byte
+## order, IMSubs files have an ID value of -16224 in native order.
+DV_MAGICS = (b"\xa0\xc0", b"\xc0\xa0")
+IMSUBS_MAGIC = struct.pack("h", -16224)
+
+## Signature of MRC image2000 files, at word 53 of the header.
+IMAGE2000_MAGIC = b"MAP "
+
+## First 4 bytes of a TIFF file, the byte order mark followed by the
+## number 42 in that byte order.
+TIFF_MAGICS = (b"II\x2a\x00", b"MM\x00\x2a")
+
+## The 1024 bytes of an IMSubs header, in native byte order and with no
+## alignment between fields.
+##   http://www.msg.ucsf.edu/IVE/IVE4_HTML/IM_ref2.html
+IMSUBS_HEADER = struct.Struct("=" + "".join([
+  "3i",   # number of columns, rows, and sections
+  "4i",   # mode, and starting point of sub image
+  "3i",   # sampling frequencies in X, Y, and Z
+  "3f",   # cell dimensions
+  "3f",   # cell angles
+  "3i",   # maps axis to dimension
+  "3f",   # minimum, maximum, and mean of the first plane
+  "2i",   # space group number, and extended header size
+  "2h",   # ID value, and unused
+  "i",    # starting time index
+  "24s",  # blank section
+  "4h",   # organization of extended header, and sub-resolution
+  "6f",   # minimum and maximum of the 2nd, 3rd, and 4th channels
+  "6h",   # image type, lens, and values depending on image type
+  "2f",   # minimum and maximum of the 5th channel
+  "2h",   # number of time points, and image sequence
+  "3f",   # X, Y, and Z tilt angle
+  "6h",   # number of wavelengths, and their lengths
+  "3f",   # origin of image
+  "i",    # number of useful titles
+  "800s", # space for 10 titles
+]))
+
+## IMSubs mode (precision) for each OMERO pixels type.  None for the
+## types that IMSubs does not support.
+IMSUBS_MODES = {
+  "int8"    : None,
+  "uint8"   : 0,
+  "int16"   : 1,
+  "uint16"  : 6,
+  "int32"   : 7,
+  "uint32"  : None,
+  "float"   : 2,
+  "double"  : None,
+  "bit"     : None,
+  "complex" : 4,
+  "doublecomplex" : None,
+}
+
+## The blank section and the titles are filled with spaces.
+IMSUBS_BLANK = b" " * 24
+IMSUBS_TITLES = b" " * 800
+
+def header_bytes(img, n):
+  """Read the first n bytes of a file.
+
+  Args:
+    img: omero.gateway._OriginalFileWrapper
+    n: number of bytes to read.
+
+  Returns:
+    A string with at most n bytes.  Shorter if the file is smaller.
+  """
+  ## A chunk may be shorter than requested, so keep reading until we
+  ## have enough or the file ends.
+  header = b""
+  for chunk in img.getFileInChunks(buf = n):
+    header += chunk
+    if len(header) >= n:
+      break
+  return header[:n]
+
 class dv_utils():
   """ Small utils for handling DV and MRC files.
 
@@ -32,9 +109,11 @@ class dv_utils():
   def __init__(self, img):
     self.img = img
     self.maybe_mrc = True
-    ## Read in the basic header. If it doesn't even have it, it
-    ## is definitely not a MRC based image file
-    self.header = self.img.getFileInChunks(buf = 1024).next()
+    ## Read in the basic header once.  All the is_* checks sniff
+    ## this same buffer so we only make one request to the server.
+    ## If it doesn't even have the full header, it is definitely not
+    ## a MRC based image file.
+    self.header = header_bytes(self.img, 1024)
     if len(self.header) < 1024:
       self.maybe_mrc = False
 
@@ -60,10 +139,7 @@ class dv_utils():
 
     ## New versions of the MRC format are supposed to have this signature
     ## but I'm still unsure if Priism is capable of reading them...
-    if self.header[52*4:53*4] == "MAP ":
-      return True
-    else:
-      return False
+    return self.header[52*4:53*4] == IMAGE2000_MAGIC
 
   @if_maybe_mrc
   def is_mrc(self):
@@ -77,7 +153,8 @@ class dv_utils():
 
     For the very old versions there is no "signature" on the
     header, we can only check if the file extension is mrc and
-    hope for the best.
+    hope for the best.  Files with the image2000 signature are
+    recognised regardless of their extension.
 
     Returns:
       A boolean value. True if img is an mrc file, False
@@ -88,12 +165,11 @@ class dv_utils():
     ##      http://bio3d.colorado.edu/imod/doc/mrc_format.txt
     ##  * Priism take on the subject:
     ##      http://msg.ucsf.edu/IVE/IVE4_HTML/mrc2image2000.html
-    ## old versions will need to check with file extension
-    ext = os.path.splitext(self.img.getName())[1]
-    if ext.lower() == ".mrc":
+    ## Newer versions have a signature on the header we already have,
+    ## old versions will need to check with file extension.
+    if self.is_image2000():
       return True
-    else:
-      return False
+    return self.img.getName().lower().endswith(".mrc")
 
   @if_maybe_mrc
   def is_dv(self):
@@ -104,11 +180,7 @@ class dv_utils():
     """
     ## According to bioformats's DeltavisionReader.java (which is GPL), a
     ## DV file must read 0xa0c0 or 0xc0a0 at pos 96.
-    m = struct.unpack("H", self.header[96:98])[0]
-    if m == 49312 or m == 41152:
-      return True
-    else:
-      return False
+    return self.header[96:98] in DV_MAGICS
 
   @if_maybe_mrc
   def is_imsubs(self):
@@ -120,32 +192,18 @@ class dv_utils():
     """
     ##  * Format specs from IVE:
     ##      http://www.msg.ucsf.edu/IVE/IVE4_HTML/IM_ref2.html
-    m = struct.unpack("H", self.header[96:98])[0]
-    if m == -16224:
-      return True
-    else:
-      return False
+    ## The ID value is a signed short (-16224) so it must be compared
+    ## as such.  Comparing the raw bytes avoids unpacking it at all.
+    return self.header[96:98] == IMSUBS_MAGIC
 
-  @staticmethod
-  def is_tiff(img):
+  def is_tiff(self):
     """Return true if image is a tiff image file.
 
-    Args:
-      img: omero.gateway._OriginalFileWrapper
-
     Returns:
       A boolean value. True if img is a tiff file,
       False otherwise.
     """
-    rv = False
-    s = img.getFileInChunks(buf=4).next()
-    if len(s) >= 4:
-      bito = s[0:2]
-      magk = s[2:4]
-      if ((bito == "II" and struct.unpack("<H", magk)[0] == 42) or
-          (bito == "MM" and struct.unpack(">H", magk)[0] == 42)):
-        rv = True
-    return rv
+    return self.header[0:4] in TIFF_MAGICS
 
   @staticmethod
   def any2imsubs(img, f):
@@ -181,109 +239,101 @@ class dv_utils():
     nchan = img.getSizeC()
     ntime = img.getSizeT()
 
-    f.write(struct.pack("2i", ncols, nrows))          # width and height
-    f.write(struct.pack("1i", nzsec * nchan * ntime)) # number of sections
-
-    pixel_types = {
-      "int8"    : None,
-      "uint8"   : 0,
-      "int16"   : 1,
-      "uint16"  : 6,
-      "int32"   : 7,
-      "uint32"  : None,
-      "float"   : 2,
-      "double"  : None,
-      "bit"     : None,
-      "complex" : 4,
-      "doublecomplex" : None,
-    }
-
-    prc = pixel_types[img.getPixelsType()] # image precision
+    ## Fetch these only once, they are used throughout.
+    px = img.getPrimaryPixels()
+    channels = list(img.getChannels())
+
+    prc = IMSUBS_MODES[img.getPixelsType()] # image precision
     ## uint8 has a value of zero which evaluates as false.  Because of
     ## that, we use "is None" instead of "not prc"
     if prc is None:
       raise omero_scripts_processing.invalid_image(
         "this image data type cannot be converted to mrc")
-
-    f.write(struct.pack("4i",
-      prc,      # image mode/precision
-      0, 0, 0,  # starting point of sub image
-    ))
-
-    ## Sampling frequencies in X, Y, and Z
-    f.write(struct.pack("3i", ncols, nrows, nzsec))
-
-    ## Cell dimensions (in ångströms). For non-crystallographic data,
-    ## set to the sampling frequency times the x pixel spacing.
-    f.write(struct.pack("3f",
-      ncols * img.getPixelSizeX() * 10000,
-      nrows * img.getPixelSizeY() * 10000,
-      nzsec * img.getPixelSizeZ() * 10000,
-    ))
-
-    f.write(struct.pack("3f", 90, 90, 90))  # cell angles (usually set to 90)
-    f.write(struct.pack("3i", 1, 2, 3))     # maps axis to dimension.
-
-    ## These values are supposed to be only for the first 2D image/plane
-    px = img.getPrimaryPixels()
-    p = px.getPlane()
-    f.write(struct.pack("3f", p.min(), p.max(), p.mean()))
-
-    f.write(struct.pack("1i", 0))         # Space group number
-    f.write(struct.pack("1i", 0))         # extended header size
-    f.write(struct.pack("1h", -16224))    # ID value
-    f.write(struct.pack("1h", 0))         # unused
-    f.write(struct.pack("1i", 0))         # starting time index
-    f.write(struct.pack("24s", " " * 24)) # blank section
-    f.write(struct.pack("2h", 0, 0))      # organization of extended header
-    f.write(struct.pack("2h", 1, 1))      # sub-resolution version of image
-
-    ## Minimum and maximum intensity of each other channel. If there is
-    ## a fifth channel, its data will be later on the header.
-    for chan in range(1, min(4, nchan)):
-      p = px.getPlane(theC = chan)
-      f.write(struct.pack("2f", p.min(), p.max()))
-    f.write(struct.pack("%if" % ((4 - nchan) *2), *[0]*((4 - nchan) *2)))
-
-    f.write(struct.pack("1h", 0))       # image type
-    f.write(struct.pack("1h", 0))       # lens identification number
-    f.write(struct.pack("4h", *[0]*4))  # depends on image type
-
-    ## Minimum and maximum intensity of a 5th channel
-    if nchan < 5:
-      f.write(struct.pack("2f", 0.0, 0.0))
-    elif nchan == 5:
-      p = px.getPlane(theC = 4)
-      f.write(struct.pack("2f", p.min(), p.max()))
-    else:
+    if nchan > 5:
       raise omero_scripts_processing.invalid_image(
         "mrc file cannot have more than 5 channels")
 
-    f.write(struct.pack("1h", ntime))   # number of time points
-    f.write(struct.pack("1h", 0))       # image sequence (0 = ZTW)
-    f.write(struct.pack("3f", 0, 0, 0)) # X, Y, and Z tilt angle
-
-    ## Number and lengths of wavelengths
-    f.write(struct.pack("1h", nchan))
-    for chan in img.getChannels():
-      ## Some channels may not have wavelength information, in which
-      ## case getEmissionWave returns None.
-      f.write(struct.pack("1h", chan.getEmissionWave() or 0))
-    for _ in range(0, 5-nchan):
-      f.write(struct.pack("1h", 0))
-
-    f.write(struct.pack("3f", 0, 0, 0))     # origin of image
-    f.write(struct.pack("i", 0))            # number of useful titles
-    f.write(struct.pack("800s", " " * 800)) # space for 10 titles
+    ## The header statistics are computed from the first plane of each
+    ## channel.  Keep those planes to write them later instead of
+    ## getting them again from the server.  Each call to getPlane opens
+    ## and closes a pixels store on the server so, here and below, all
+    ## planes are requested in one go with getPlanes.
+    first_planes = list(px.getPlanes([(0, c, 0) for c in range(0, nchan)]))
 
+    ## These values are supposed to be only for the first 2D image/plane
+    p = first_planes[0]
+    first_stats = [p.min(), p.max(), p.mean()]
+
+    ## Minimum and maximum intensity of each other channel.  The 5th
+    ## channel comes later on the header.  Channels that do not exist
+    ## are left as zero.
+    chan_stats = [0.0] * 8
+    for chan in range(1, nchan):
+      p = first_planes[chan]
+      chan_stats[2*chan-2:2*chan] = [p.min(), p.max()]
+
+    ## Some channels may not have wavelength information, in which
+    ## case getEmissionWave returns None.  There is always space for 5
+    ## wavelengths.
+    waves = [0] * 5
+    for i, chan in enumerate(channels):
+      waves[i] = chan.getEmissionWave() or 0
+
+    ## The whole header is packed and written at once.
+    f.write(IMSUBS_HEADER.pack(*(
+      [ncols, nrows]                # width and height
+      + [nzsec * nchan * ntime]     # number of sections
+      + [prc, 0, 0, 0]              # mode and starting point of sub image
+      + [ncols, nrows, nzsec]       # sampling frequencies in X, Y, and Z
+      ## Cell dimensions (in ångströms). For non-crystallographic data,
+      ## set to the sampling frequency times the x pixel spacing.
+      + [ncols * img.getPixelSizeX() * 10000,
+         nrows * img.getPixelSizeY() * 10000,
+         nzsec * img.getPixelSizeZ() * 10000]
+      + [90, 90, 90]                # cell angles (usually set to 90)
+      + [1, 2, 3]                   # maps axis to dimension.
+      + first_stats
+      + [0, 0]                      # space group, extended header size
+      + [-16224, 0]                 # ID value, unused
+      + [0]                         # starting time index
+      + [IMSUBS_BLANK]              # blank section
+      + [0, 0]                      # organization of extended header
+      + [1, 1]                      # sub-resolution version of image
+      + chan_stats[0:6]
+      + [0, 0, 0, 0, 0, 0]          # image type, lens, image type data
+      + chan_stats[6:8]
+      + [ntime, 0]                  # time points, image sequence (ZTW)
+      + [0, 0, 0]                   # X, Y, and Z tilt angle
+      + [nchan] + waves             # number and lengths of wavelengths
+      + [0, 0, 0]                   # origin of image
+      + [0]                         # number of useful titles
+      + [IMSUBS_TITLES]             # space for 10 titles
+    )))
+
+    ## Map the pixel data section of the file and copy each plane,
+    ## flipped and cast, straight into its place.  This avoids any
+    ## intermediate arrays and a write call per plane.
+    ## https://github.com/openmicroscopy/openmicroscopy/issues/2547
+    dtype = first_planes[0].dtype
+    if dtype == "float64":
+      dtype = numpy.dtype("float32")
+    f.flush()
+    data = numpy.memmap(f.file, dtype = dtype, mode = "r+",
+                        offset = IMSUBS_HEADER.size,
+                        shape = (nchan, ntime, nzsec, nrows, ncols))
+    planes = px.getPlanes([(z, w, t) for w in range(0, nchan)
+                                     for t in range(0, ntime)
+                                     for z in range(0, nzsec)
+                                     if t != 0 or z != 0])
     for w in range(0, nchan):
       for t in range(0, ntime):
         for z in range(0, nzsec):
-          p = px.getPlane(theC=w, theT=t, theZ=z)
-          ## https://github.com/openmicroscopy/openmicroscopy/issues/2547
-          if p.dtype == "float64":
-            p = p.astype("float32")
-          p = numpy.flipud(p)
-          p.tofile(f.file)
-    f.flush()
+          if t == 0 and z == 0:
+            p = first_planes[w]
+            first_planes[w] = None
+          else:
+            p = next(planes)
+          data[w, t, z] = p[::-1]
+    data.flush()
+    del data
 
@@ -16,6 +16,7 @@
 ## You should have received a copy of the GNU Affero General Public License
 ## along with this program; if not, see <http://www.gnu.org/licenses/>.
 
+import mmap
 import os
 import os.path
 
@@ -63,6 +64,9 @@ class ndsafir(omero_scripts_processing.bin_block):
   institutions = ["Micron, University of Oxford"]
   contact      = "david.pinto@bioch.ox.ac.uk"
 
+  ## Size of the chunks when downloading the original file (4 MiB).
+  chunk_size = 4 * 1024 * 1024
+
   schema = voluptuous.Schema(
     {
       "time"              : bool,
@@ -86,6 +90,17 @@ class ndsafir(omero_scripts_processing.bin_block):
     required = True,
   )
 
+  ## Format for the ndsafir options that map directly to one of ours.
+  bin_opts_formats = [
+    "-iter=%(iterations)i",
+    "-p=%(patch_radius)i",
+    "-noise=%(noise_model)s",
+    ## FIXME https://github.com/openmicroscopy/openmicroscopy/issues/2449
+#    "-adapt=%(adaptability)f",
+    "-island=%(island_threshold)f",
+    "-sampling=%(sampling)i",
+  ]
+
   def __init__(self, bin_path):
     super(ndsafir, self).__init__(bin_path)
     self.args = [
@@ -177,14 +192,29 @@ class ndsafir(omero_scripts_processing.bin_block):
     ## files. Depending on the answer, may require some changes.
     ## Hopefully it is for cases when a ND image comes from multiple
     ## files in which case they wouldn't be mrc files anyway.
+    ## IMSubs files have one of the DV signatures so is_dv() already
+    ## covers them, there is no need to check is_imsubs() as well.
     for f in self.parent.getImportedImageFiles():
       fdv = dv_utils.dv_utils(f)
-      if fdv.is_dv() or fdv.is_image2000() or fdv.is_imsubs():
+      if fdv.is_dv() or fdv.is_image2000():
         ext = os.path.splitext(f.getName())[1]
         self.fin = self.get_tmp_file(suffix = ext)
-        for c in f.getFileInChunks():
-          self.fin.write(c)
-        self.fin.flush()
+        ## Allocate the whole file up front and copy the chunks
+        ## straight into a map of it, instead of growing the file on
+        ## each write.  Larger chunks also mean fewer server calls.
+        size = f.getSize()
+        self.fin.truncate(size)
+        fmap = mmap.mmap(self.fin.fileno(), size)
+        try:
+          offset = 0
+          for c in f.getFileInChunks(buf = self.chunk_size):
+            if offset + len(c) > size:
+              raise RuntimeError("got more than the %i bytes of file '%s'"
+                                 % (size, f.getName()))
+            fmap[offset:offset+len(c)] = c
+            offset += len(c)
+        finally:
+          fmap.close()
         break
     else:
       self.fin = self.get_tmp_file(suffix = ".mrc")
@@ -241,15 +271,7 @@ class ndsafir(omero_scripts_processing.bin_block):
     if "sampling" not in self.options:
       self.options["sampling"] = float(self.options["patch_radius"] +1)
 
-    opts += [
-      "-iter=%i"      % (self.options["iterations"]),
-      "-p=%i"         % (self.options["patch_radius"]),
-      "-noise=%s"     % (self.options["noise_model"]),
-      ## FIXME https://github.com/openmicroscopy/openmicroscopy/issues/2449
-#      "-adapt=%f"     % (self.options["adaptability"]),
-      "-island=%f"    % (self.options["island_threshold"]),
-      "-sampling=%i"  % (self.options["sampling"]),
-    ]
+    opts += [fmt % self.options for fmt in self.bin_opts_formats]
 
     self.bin_opts = opts
 
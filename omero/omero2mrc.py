@@ -18,10 +18,122 @@
 
 import getpass
 import struct
+import threading
+
+try:
+  import queue
+except ImportError: # Python 2
+  import Queue as queue
 
 import numpy
 import omero.gateway
 
+## The 1024 bytes of an IMSubs header, in native byte order and with no
+## alignment between fields.
+##   http://www.msg.ucsf.edu/IVE/IVE4_HTML/IM_ref2.html
+IMSUBS_HEADER = struct.Struct("=" + "".join([
+  "3i",   # number of columns, rows, and sections
+  "4i",   # mode, and starting point of sub image
+  "3i",   # sampling frequencies in X, Y, and Z
+  "3f",   # cell dimensions
+  "3f",   # cell angles
+  "3i",   # maps axis to dimension
+  "3f",   # minimum, maximum, and mean of the first plane
+  "2i",   # space group number, and extended header size
+  "2h",   # ID value, and unused
+  "i",    # starting time index
+  "24s",  # blank section
+  "4h",   # organization of extended header, and sub-resolution
+  "6f",   # minimum and maximum of the 2nd, 3rd, and 4th channels
+  "6h",   # image type, lens, and values depending on image type
+  "2f",   # minimum and maximum of the 5th channel
+  "2h",   # number of time points, and image sequence
+  "3f",   # X, Y, and Z tilt angle
+  "6h",   # number of wavelengths, and their lengths
+  "3f",   # origin of image
+  "i",    # number of useful titles
+  "800s", # space for 10 titles
+]))
+
+## IMSubs mode (precision) for each OMERO pixels type.  None for the
+## types that IMSubs does not support.
+IMSUBS_MODES = {
+  "int8"    : None,
+  "uint8"   : 0,
+  "int16"   : 1,
+  "uint16"  : 6,
+  "int32"   : 7,
+  "uint32"  : None,
+  "float"   : 2,
+  "double"  : None,
+  "bit"     : None,
+  "complex" : 4,
+  "doublecomplex" : None,
+}
+
+## The blank section and the titles are filled with spaces.
+IMSUBS_BLANK = b" " * 24
+IMSUBS_TITLES = b" " * 800
+
+## numpy type for the data of each IMSubs mode.  Note that OMERO may
+## give planes of float images as float64 so they need to be cast.
+## https://github.com/openmicroscopy/openmicroscopy/issues/2547
+IMSUBS_DTYPES = {
+  0 : "uint8",
+  1 : "int16",
+  2 : "float32",
+  4 : "complex64",
+  6 : "uint16",
+  7 : "int32",
+}
+
+def prefetch(iterable, n):
+  """Iterate in a separate thread, keeping up to n items ready.
+
+  Used to overlap getting planes from the server with writing them to
+  disk.  Exceptions in the thread are raised again in the caller.  If
+  the caller stops early, the thread stops too and closes iterable,
+  so that getPlanes closes its pixels store.
+  """
+  items = queue.Queue(n)
+  stop = threading.Event()
+  done = object()
+  def put(item):
+    ## Do not block forever on a full queue if nobody will get it.
+    while not stop.is_set():
+      try:
+        items.put(item, timeout = 0.1)
+        return True
+      except queue.Full:
+        pass
+    return False
+  def produce():
+    try:
+      for item in iterable:
+        if not put((item, None)):
+          return
+    except Exception as e:
+      put((done, e))
+    else:
+      put((done, None))
+    finally:
+      close = getattr(iterable, "close", None)
+      if close is not None:
+        close()
+  thread = threading.Thread(target = produce)
+  thread.daemon = True
+  thread.start()
+  try:
+    while True:
+      item, error = items.get()
+      if item is done:
+        if error is not None:
+          raise error
+        return
+      yield item
+  finally:
+    stop.set()
+
 def write_imsubs(img, f):
   """Save image into a mrc Imsubs (Priism sub-format) file.
 
@@ -35,7 +147,8 @@ def write_imsubs(img, f):
 
   Args:
     img: omero.gateway._ImageWrapper
-    f: a file handle for a file open for writing
+    f: a file handle for a file open for reading and writing (the
+      pixel data is written through a memory map of the file).
 
   Returns:
     void
@@ -54,109 +167,100 @@ def write_imsubs(img, f):
   nchan = img.getSizeC()
   ntime = img.getSizeT()
 
-  f.write(struct.pack("2i", ncols, nrows))          # width and height
-  f.write(struct.pack("1i", nzsec * nchan * ntime)) # number of sections
-
-  pixel_types = {
-    "int8"    : None,
-    "uint8"   : 0,
-    "int16"   : 1,
-    "uint16"  : 6,
-    "int32"   : 7,
-    "uint32"  : None,
-    "float"   : 2,
-    "double"  : None,
-    "bit"     : None,
-    "complex" : 4,
-    "doublecomplex" : None,
-  }
-
-  prc = pixel_types[img.getPixelsType()] # image precision
+  prc = IMSUBS_MODES[img.getPixelsType()] # image precision
   ## uint8 has a value of zero which evaluates as false.  Because of
   ## that, we use "is None" instead of "not prc"
   if prc is None:
     raise TypeError("this image data type cannot be converted to mrc")
+  if nchan > 5:
+    raise TypeError("mrc file cannot have more than 5 channels")
 
-  f.write(struct.pack("4i",
-                      prc,      # image mode/precision
-                      0, 0, 0,  # starting point of sub image
-                    ))
+  ## The header statistics are computed from the first plane of each
+  ## channel, all fetched with a single getPlanes call.  These planes
+  ## are kept to be written later instead of getting them again.
+  px = img.getPrimaryPixels()
+  first_planes = list(px.getPlanes([(0, c, 0) for c in range(0, nchan)]))
 
-  ## Sampling frequencies in X, Y, and Z
-  f.write(struct.pack("3i", ncols, nrows, nzsec))
+  ## These values are supposed to be only for the first 2D image/plane
+  p = first_planes[0]
+  first_stats = [p.min(), p.max(), p.mean()]
 
-  ## Cell dimensions (in ångströms). For non-crystallographic data,
-  ## set to the sampling frequency times the x pixel spacing.
-  f.write(struct.pack("3f",
-                      ncols * img.getPixelSizeX() * 10000,
-                      nrows * img.getPixelSizeY() * 10000,
-                      nzsec * img.getPixelSizeZ() * 10000,
-                    ))
+  ## Minimum and maximum intensity of each other channel.  The 5th
+  ## channel comes later on the header.  Channels that do not exist
+  ## are left as zero.
+  chan_stats = [0.0] * 8
+  for chan in range(1, nchan):
+    p = first_planes[chan]
+    chan_stats[2*chan-2:2*chan] = [p.min(), p.max()]
 
-  f.write(struct.pack("3f", 90, 90, 90))  # cell angles (usually set to 90)
-  f.write(struct.pack("3i", 1, 2, 3))     # maps axis to dimension.
+  ## Some channels may not have wavelength information, in which
+  ## case getEmissionWave returns None.  There is always space for 5
+  ## wavelengths.
+  waves = [0] * 5
+  for i, chan in enumerate(img.getChannels()):
+    waves[i] = chan.getEmissionWave() or 0
 
-  ## These values are supposed to be only for the first 2D image/plane
-  px = img.getPrimaryPixels()
-  p = px.getPlane()
-  f.write(struct.pack("3f", p.min(), p.max(), p.mean()))
-
-  f.write(struct.pack("1i", 0))         # Space group number
-  f.write(struct.pack("1i", 0))         # extended header size
-  f.write(struct.pack("1h", -16224))    # ID value
-  f.write(struct.pack("1h", 0))         # unused
-  f.write(struct.pack("1i", 0))         # starting time index
-  f.write(struct.pack("24s", " " * 24)) # blank section
-  f.write(struct.pack("2h", 0, 0))      # organization of extended header
-  f.write(struct.pack("2h", 1, 1))      # sub-resolution version of image
-
-  ## Minimum and maximum intensity of each other channel. If there is
-  ## a fifth channel, its data will be later on the header.
-  for chan in range(1, min(4, nchan)):
-    p = px.getPlane(theC = chan)
-    f.write(struct.pack("2f", p.min(), p.max()))
-  f.write(struct.pack("%if" % ((4 - nchan) *2), *[0]*((4 - nchan) *2)))
-
-  f.write(struct.pack("1h", 0))       # image type
-  f.write(struct.pack("1h", 0))       # lens identification number
-  f.write(struct.pack("4h", *[0]*4))  # depends on image type
-
-  ## Minimum and maximum intensity of a 5th channel
-  if nchan < 5:
-    f.write(struct.pack("2f", 0.0, 0.0))
-  elif nchan == 5:
-    p = px.getPlane(theC = 4)
-    f.write(struct.pack("2f", p.min(), p.max()))
-  else:
-    raise TypeError("mrc file cannot have more than 5 channels")
+  ## The whole header is packed and written at once.
+  f.write(IMSUBS_HEADER.pack(*(
+    [ncols, nrows]                # width and height
+    + [nzsec * nchan * ntime]     # number of sections
+    + [prc, 0, 0, 0]              # mode and starting point of sub image
+    + [ncols, nrows, nzsec]       # sampling frequencies in X, Y, and Z
+    ## Cell dimensions (in ångströms). For non-crystallographic data,
+    ## set to the sampling frequency times the x pixel spacing.
+    + [ncols * img.getPixelSizeX() * 10000,
+       nrows * img.getPixelSizeY() * 10000,
+       nzsec * img.getPixelSizeZ() * 10000]
+    + [90, 90, 90]                # cell angles (usually set to 90)
+    + [1, 2, 3]                   # maps axis to dimension.
+    + first_stats
+    + [0, 0]                      # space group, extended header size
+    + [-16224, 0]                 # ID value, unused
+    + [0]                         # starting time index
+    + [IMSUBS_BLANK]              # blank section
+    + [0, 0]                      # organization of extended header
+    + [1, 1]                      # sub-resolution version of image
+    + chan_stats[0:6]
+    + [0, 0, 0, 0, 0, 0]          # image type, lens, image type data
+    + chan_stats[6:8]
+    + [ntime, 0]                  # time points, image sequence (ZTW)
+    + [0, 0, 0]                   # X, Y, and Z tilt angle
+    + [nchan] + waves             # number and lengths of wavelengths
+    + [0, 0, 0]                   # origin of image
+    + [0]                         # number of useful titles
+    + [IMSUBS_TITLES]             # space for 10 titles
+  )))
 
-  f.write(struct.pack("1h", ntime))   # number of time points
-  f.write(struct.pack("1h", 0))       # image sequence (0 = ZTW)
-  f.write(struct.pack("3f", 0, 0, 0)) # X, Y, and Z tilt angle
-
-  ## Number and lengths of wavelengths
-  f.write(struct.pack("1h", nchan))
-  for chan in img.getChannels():
-    ## Some channels may not have wavelength information, in which
-    ## case getEmissionWave returns None.
-    f.write(struct.pack("1h", chan.getEmissionWave() or 0))
-  for _ in range(0, 5-nchan):
-    f.write(struct.pack("1h", 0))
-
-  f.write(struct.pack("3f", 0, 0, 0))     # origin of image
-  f.write(struct.pack("i", 0))            # number of useful titles
-  f.write(struct.pack("800s", " " * 800)) # space for 10 titles
-
-  for w in range(0, nchan):
-    for t in range(0, ntime):
-      for z in range(0, nzsec):
-        p = px.getPlane(theC=w, theT=t, theZ=z)
-        ## https://github.com/openmicroscopy/openmicroscopy/issues/2547
-        if p.dtype == "float64":
-          p = p.astype("float32")
-        p = numpy.flipud(p)
-        p.tofile(f)
+  ## Each call to getPlane opens and closes a pixels store on the
+  ## server, so request all planes in one go instead.  The planes are
+  ## fetched in the background while the previous ones are written.
+  planes = prefetch(px.getPlanes([(z, w, t) for w in range(0, nchan)
+                                            for t in range(0, ntime)
+                                            for z in range(0, nzsec)
+                                            if t != 0 or z != 0]), 4)
+  ## Map the pixel data section of the file and copy each plane,
+  ## flipped and cast, straight into its place.  The kernel writes the
+  ## pages back on its own, with no intermediate arrays nor a write
+  ## call per plane.
   f.flush()
+  data = numpy.memmap(f, dtype = IMSUBS_DTYPES[prc], mode = "r+",
+                      offset = IMSUBS_HEADER.size,
+                      shape = (nchan, ntime, nzsec, nrows, ncols))
+  try:
+    for w in range(0, nchan):
+      for t in range(0, ntime):
+        for z in range(0, nzsec):
+          if t == 0 and z == 0:
+            p = first_planes[w]
+            first_planes[w] = None
+          else:
+            p = next(planes)
+          data[w, t, z] = p[::-1]
+  finally:
+    ## Stop fetching planes if writing them failed.
+    planes.close()
+  data.flush()
+  del data
   return
 
 def main():
@@ -177,7 +281,9 @@ def main():
     raise RuntimeError("Failed to get image with ID:%i" % image_id)
 
   fpath = "foo.mrc"
-  with open(fpath, "w") as fh:
+  ## MRC is a binary format.  The file must be open for reading too,
+  ## so that the pixel data can be memory mapped.
+  with open(fpath, "w+b") as fh:
     write_imsubs(image, fh)
 
 if __name__ == "__main__":
@@ -10,8 +10,10 @@
 
 import os.path
 import re
+import sys
 
 import omero.gateway
+import omero.sys
 import omero.util.sessions
 
 
@@ -49,7 +51,8 @@ all_experiment_defs = {
         {
             'userID' : 3905, # Rita
             'project' : '^RF2019-01_03$',
-            'dataset' : '^(?!RF2019-01_03_1_HeLa_H2B-GFP-Boost_DAPI$)',
+            'dataset' : '.*',
+            'dataset_exclude' : {'RF2019-01_03_1_HeLa_H2B-GFP-Boost_DAPI'},
             'image' : '.*_SIR_THR_ALN-1.tif$',
         },
     ],
@@ -118,46 +121,104 @@ def get_connection():
                                       port=session_props[3])
     if not conn.connect(session_uuid):
         raise RuntimeError('failed to connect to session')
+    # The same connection is used for all queries, keep the session
+    # alive between them.
+    conn.c.enableKeepAlive(60)
     return conn
 
 
+def literal_name(pattern):
+    """Name matched by a pattern, or None if it matches more than one.
+
+    Patterns such as '^Miron-C127-G1$' only match one name so we can
+    have the server filter by it instead of listing everything.
+    """
+    match = re.match(r'^\^([^\\.^$*+?{}\[\]|()]*)\$$', pattern)
+    if match is None:
+        return None
+    return match.group(1)
+
+
+def get_server_paths(conn, image_ids):
+    """Map image ids to the server paths of their imported files.
+
+    Same as getImportedImageFilePaths()['server_paths'] but for
+    all images in a single query instead of one call per image.
+    """
+    server_paths = {image_id: [] for image_id in image_ids}
+    if not image_ids:
+        return server_paths
+    params = omero.sys.ParametersI()
+    params.addIds(image_ids)
+    query = ('select i.id, f.path, f.name from Image i'
+             ' join i.fileset fs join fs.usedFiles u join u.originalFile f'
+             ' where i.id in (:ids)')
+    ctx = {'omero.group': str(schermellehgroup)}
+    for row in conn.getQueryService().projection(query, params, ctx):
+        server_paths[row[0].val].append(row[1].val + row[2].val)
+    return server_paths
+
+
 def find_files(conn, defs):
-    paths_map = {}
+    project_re = re.compile(defs['project'])
+    dataset_re = re.compile(defs['dataset'])
+    image_re = re.compile(defs['image'])
+    # Names of datasets to skip even if they match the dataset pattern.
+    dataset_exclude = defs.get('dataset_exclude', set())
+    images = []
     opts = {
         'owner': defs['userID'],
         'group': schermellehgroup,
     }
-    for project in conn.getObjects('Project', opts=opts):
-        if re.match(defs['project'], project.getName()) is None:
+    attributes = None
+    project_name = literal_name(defs['project'])
+    if project_name is not None:
+        attributes = {'name': project_name}
+    for project in conn.getObjects('Project', attributes=attributes,
+                                   opts=opts):
+        if project_re.match(project.getName()) is None:
             continue
         for dataset in project.listChildren():
-            if re.match(defs['dataset'], dataset.getName()) is None:
+            if dataset.getName() in dataset_exclude:
+                continue
+            if dataset_re.match(dataset.getName()) is None:
                 continue
             for image in dataset.listChildren():
-                if re.match(defs['image'], image.getName()) is None:
+                if image_re.match(image.getName()) is None:
                     continue
-                server_path = image.getImportedImageFilePaths()['server_paths']
-                if len(server_path) != 1:
-                    # We know that in our filesets there's only one
-                    # file per image.
-                    raise Exception('we only expect 1 file per image')
-                local_path = server_path[0]
                 remote_path = os.path.join(project.getName(),
                                            dataset.getName(),
                                            image.getName())
-                paths_map[local_path] = remote_path
+                images.append((image.getId(), remote_path))
+
+    server_paths = get_server_paths(conn, [i[0] for i in images])
+    paths_map = {}
+    for image_id, remote_path in images:
+        server_path = server_paths[image_id]
+        if len(server_path) != 1:
+            # We know that in our filesets there's only one
+            # file per image.
+            raise Exception('we only expect 1 file per image')
+        local_path = server_path[0]
+        paths_map[local_path] = remote_path
     return paths_map
 
 
 conn = get_connection()
-
-for experiment_name, experiment_defs in all_experiment_defs.items():
-    for defs in experiment_defs:
-        paths_map = find_files(conn, defs)
-        for local_path, remote_path in paths_map.items():
-            local_path = os.path.join(basepath, local_path)
-            remote_path = os.path.join(experiment_name, remote_path)
-            if ',' in local_path or ',' in remote_path:
-                # If there's a comma on the path it's tricky
-                raise Exception('hmmm.... we have commas on the paths')
-            print '%s,%s' % (local_path, remote_path)
+lines = []
+try:
+    for experiment_name, experiment_defs in all_experiment_defs.items():
+        for defs in experiment_defs:
+            paths_map = find_files(conn, defs)
+            for local_path, remote_path in paths_map.items():
+                local_path = os.path.join(basepath, local_path)
+                remote_path = os.path.join(experiment_name, remote_path)
+                if ',' in local_path or ',' in remote_path:
+                    # If there's a comma on the path it's tricky
+                    raise Exception('hmmm.... we have commas on the paths')
+                lines.append('%s,%s\n' % (local_path, remote_path))
+finally:
+    # Do not kill the session, it was not created by us.
+    conn.close(hard=False)
+# Write all lines at once instead of one print per file.
+sys.stdout.write(''.join(lines))
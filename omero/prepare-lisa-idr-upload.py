@@ -14,6 +14,7 @@ import sys
 import typing
 
 import omero.gateway
+import omero.sys
 import omero.util.sessions
 
 assays_file_column = 16
@@ -25,19 +26,17 @@ basepath = ''
 
 def read_names(fpath):
     names = set()
-    line_count = 0
     with open(fpath, 'r') as fh:
         header = fh.readline().split('\t')
         if header[assays_file_column] != 'Image File':
             raise RuntimeError('column is wrong')
         fh.readline()  # discard line of comments
         for line in fh:
-            line_count += 1
-            names.add(line.split('\t')[assays_file_column])
-
-    if len(names) != line_count:
-        raise RuntimeError('duplicated names? We have %d names from %d lines'
-                           % (len(names), line_count))
+            # No need to split the columns after the one we want.
+            name = line.split('\t', assays_file_column +1)[assays_file_column]
+            if name in names:
+                raise RuntimeError('duplicated name %s' % name)
+            names.add(name)
     return names
 
 
@@ -53,49 +52,90 @@ def get_connection():
                                       port=session_props[3])
     if not conn.connect(session_uuid):
         raise RuntimeError('failed to connect to session')
+    # The same connection is used for all queries, keep the session
+    # alive between them.
+    conn.c.enableKeepAlive(60)
     return conn
 
 
+def get_server_paths(conn, image_ids):
+    """Map image ids to the server paths of their imported files.
+
+    Same as getImportedImageFilePaths()['server_paths'] but for
+    all images in a single query instead of one call per image.
+    """
+    server_paths = {image_id: [] for image_id in image_ids}
+    if not image_ids:
+        return server_paths
+    params = omero.sys.ParametersI()
+    params.addIds(image_ids)
+    query = ('select i.id, f.path, f.name from Image i'
+             ' join i.fileset fs join fs.usedFiles u join u.originalFile f'
+             ' where i.id in (:ids)')
+    ctx = {'omero.group': str(schermelleh_gid)}
+    for row in conn.getQueryService().projection(query, params, ctx):
+        server_paths[row[0].val].append(row[1].val + row[2].val)
+    return server_paths
+
+
 def find_files(conn, names):
     names = names.copy()
-    paths_map = {}
+    images = []
     opts = {
         'owner': lisa_uid,
         'group': schermelleh_gid,
     }
-    for project in conn.getObjects('Project', opts=opts):
-        # It's all in this project
-        if project.getName() != "Xist RNA dynamics":
-            continue
-
+    # It's all in this project
+    attributes = {'name': 'Xist RNA dynamics'}
+    for project in conn.getObjects('Project', attributes=attributes,
+                                   opts=opts):
         for dataset in project.listChildren():
             for image in dataset.listChildren():
                 try:
                     names.remove(image.getName())
                 except KeyError:
                     continue
-
-                server_path = image.getImportedImageFilePaths()['server_paths']
-                if len(server_path) != 1:
-                    # We know that in our filesets there's only one
-                    # file per image.
-                    raise Exception('we only expect 1 file per image but %s'
-                                    % server_path)
-                local_path = server_path[0]
                 remote_path = os.path.join(project.getName(),
                                            dataset.getName(),
                                            image.getName())
-                paths_map[local_path] = remote_path
+                images.append((image.getId(), remote_path))
+                # Stop going through the project once all images
+                # have been found.
+                if not names:
+                    break
+            if not names:
+                break
+        if not names:
+            break
     if len(names) != 0:
         raise Exception('failed to find the following images: %s' % names)
+
+    server_paths = get_server_paths(conn, [i[0] for i in images])
+    paths_map = {}
+    for image_id, remote_path in images:
+        server_path = server_paths[image_id]
+        if len(server_path) != 1:
+            # We know that in our filesets there's only one
+            # file per image.
+            raise Exception('we only expect 1 file per image but %s'
+                            % server_path)
+        local_path = server_path[0]
+        paths_map[local_path] = remote_path
     return paths_map
 
 
 conn = get_connection()
-names = read_names(sys.argv[1])
-paths_map = find_files(conn, names)
+try:
+    names = read_names(sys.argv[1])
+    paths_map = find_files(conn, names)
+finally:
+    # Do not kill the session, it was not created by us.
+    conn.close(hard=False)
+lines = []
 for local_path, remote_path in paths_map.items():
     if ',' in local_path or ',' in remote_path:
         # If there's a comma on the path it's tricky
         raise Exception('hmmm.... we have commas on the paths')
-    print '%s,%s' % (local_path, remote_path)
+    lines.append('%s,%s\n' % (local_path, remote_path))
+# Write all lines at once instead of one print per file.
+sys.stdout.write(''.join(lines))
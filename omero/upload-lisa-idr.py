@@ -11,6 +11,12 @@ import ftplib
 import os
 import os.path
 import sys
+import threading
+
+try:
+    import queue
+except ImportError: # Python 2
+    import Queue as queue
 
 local_base = '/OMERO/ManagedRepository/'
 remote_base = '/incoming/lisa-rodermund/'
@@ -19,28 +25,60 @@ ftp_host = ''
 ftp_port = 21
 ftp_user = ''
 ftp_passwd = ''
+n_connections = 4
+# Bytes read from the file and sent at a time, ftplib default is 8KiB.
+ftp_blocksize = 1024 * 1024
 
 
 desc_filepath = sys.argv[1]
 if not os.access(desc_filepath, os.R_OK):
     raise Exception("can't read file: %s" % desc_filepath)
 
-ftp_conn = ftplib.FTP()
+def ftp_connect():
+    ftp_conn = ftplib.FTP()
+    ftp_conn.connect(ftp_host, ftp_port)
+    ftp_conn.login(ftp_user, ftp_passwd)
+    ftp_conn.set_pasv(True)
+    return ftp_conn
 
-ftp_conn.connect(ftp_host, ftp_port)
-ftp_conn.login(ftp_user, ftp_passwd)
-ftp_conn.set_pasv(True)
 
-ftp_conn.cwd('/incoming')
-try:
-    ftp_conn.mkd('lisa-rodermund')
-except ftplib.error_perm as e:
-    if e[0].startswith('550 '):
-        # we hope this is because the directory already exists
-        pass
-    else:
-        raise
+def ftp_disconnect(ftp_conn):
+    try:
+        ftp_conn.quit()
+    except:
+        ftp_conn.close()
+
+
+def upload(transfers, errors):
+    """Upload files from the transfers queue until it is empty.
 
+    Each thread running this has its own connection.  All files go to
+    remote_base so each connection only changes directory once.
+    """
+    ftp_conn = None
+    try:
+        # Connecting may fail too, for example if the server refuses
+        # more connections, and that must also reach the main thread.
+        ftp_conn = ftp_connect()
+        print('moving to ' + remote_base)
+        ftp_conn.cwd(remote_base)
+        while not errors:
+            try:
+                local_abs_path, remote_filename = transfers.get_nowait()
+            except queue.Empty:
+                break
+            print('storing %s' % local_abs_path)
+            with open(local_abs_path, 'rb') as data_fh:
+                ftp_conn.storbinary('STOR %s' % remote_filename, data_fh,
+                                    blocksize=ftp_blocksize)
+    except Exception as e:
+        errors.append(e)
+    finally:
+        if ftp_conn is not None:
+            ftp_disconnect(ftp_conn)
+
+
+transfers = []
 with open(desc_filepath, 'r') as desc_fh:
     for line in desc_fh:
         line = line.rstrip()  # drop newline
@@ -48,17 +86,34 @@ with open(desc_filepath, 'r') as desc_fh:
         omero_fname = os.path.basename(omero_path)
 
         local_abs_path = os.path.join(local_base, local_rel_path)
-        remote_abs_path = os.path.join(remote_base, omero_fname)
+        # All files go to the same directory, remote_base, regardless
+        # of where they are on OMERO.
+        transfers.append((local_abs_path, omero_fname))
 
-        remote_basedir, remote_filename = os.path.split(remote_abs_path)
+ftp_conn = ftp_connect()
+ftp_conn.cwd('/incoming')
+try:
+    ftp_conn.mkd('lisa-rodermund')
+except ftplib.error_perm as e:
+    if e[0].startswith('550 '):
+        # we hope this is because the directory already exists
+        pass
+    else:
+        raise
+ftp_disconnect(ftp_conn)
 
-        print('moving to ' + remote_basedir)
-        ftp_conn.cwd(remote_basedir)
-        print('storing %s' % local_abs_path)
-        with open(local_abs_path, 'rb') as data_fh:
-            ftp_conn.storbinary('STOR %s' % remote_filename, data_fh)
+# Most of the time goes on the round trips for each file so upload
+# over multiple connections.
+transfers_queue = queue.Queue()
+for transfer in transfers:
+    transfers_queue.put(transfer)
 
-try:
-    ftp_conn.quit()
-except:
-    ftp_conn.close()
+errors = []
+threads = [threading.Thread(target=upload, args=(transfers_queue, errors))
+           for _ in range(n_connections)]
+for thread in threads:
+    thread.start()
+for thread in threads:
+    thread.join()
+if errors:
+    raise errors[0]
@@ -33,20 +33,34 @@
 
 import argparse
 import collections
+import concurrent.futures
 import datetime
 import json
 import os
+import re
 import sys
 
 import matplotlib.pyplot
 
+## orjson is much faster at parsing the OMERO du files but is not
+## always installed.  Both take the whole file as bytes.
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
 class PIGroup():
+    __slots__ = ('pi_name', 'affiliation', 'unix_gid')
+
     def __init__(self, pi_name, affiliation, unix_gid):
         self.pi_name = pi_name
         self.affiliation = affiliation
         self.unix_gid = unix_gid
 
 class OMEROGroup():
+    __slots__ = ('omero_gid', 'name', 'payee')
+
     def __init__(self, omero_gid, name, payee):
         self.omero_gid = omero_gid
         self.name = name
@@ -137,9 +151,18 @@ def _create_PI_groups():
         ['Ulrike Gruneberg', 'Pathology', 18777],
         ['Wolfson Imaging Center', 'WIMM', 18767],
     ]
-    return [PIGroup(x[0], x[1], x[2]) for x in groups]
+    return tuple(PIGroup(x[0], x[1], x[2]) for x in groups)
 PI_GROUPS = _create_PI_groups()
 
+def _create_PI_groups_by_name():
+    pi_by_name = dict()
+    for grp in PI_GROUPS:
+        if grp.pi_name in pi_by_name:
+            raise RuntimeError("no unique PI group for '%s'" % grp.pi_name)
+        pi_by_name[grp.pi_name] = grp
+    return pi_by_name
+PI_GROUPS_BY_NAME = _create_PI_groups_by_name()
+
 def _create_omero_groups():
     groups = [
         [   0, 'system', 'Micron'],
@@ -221,14 +244,31 @@ def _create_omero_groups():
     omero_groups = dict()
     for x in groups:
         pi = x[2]
-        pi_grp = [grp for grp in PI_GROUPS if grp.pi_name == pi]
-        if len(pi_grp) != 1:
-            raise RuntimeError("no unique PI group for '%s', found %s"
-                               % (pi, pi_grp))
-        omero_groups[x[0]] = OMEROGroup(x[0], x[1], pi_grp[0])
+        pi_grp = PI_GROUPS_BY_NAME.get(pi)
+        if pi_grp is None:
+            raise RuntimeError("no PI group for '%s'" % pi)
+        omero_groups[x[0]] = OMEROGroup(x[0], x[1], pi_grp)
     return omero_groups
 OMERO_GROUPS = _create_omero_groups()
 
+## The maps from OMERO and unix group ids to PI groups are used for
+## each of the aggregations so only build them once.
+OMERO_GID_TO_PI_GROUP = {grp.omero_gid : grp.payee
+                         for grp in OMERO_GROUPS.values()}
+
+def _create_unix_gid_to_PI_group():
+    grp_map = dict()
+    for grp in PI_GROUPS:
+        gid = grp.unix_gid
+        if not gid:
+            continue # guess this PI does not have a micron group
+        if grp_map.get(gid):
+            raise RuntimeError("found '%s' and '%s' with unix gid '%i'"
+                               % (grp_map[gid], grp.pi_name, gid))
+        grp_map[gid] = grp
+    return grp_map
+UNIX_GID_TO_PI_GROUP = _create_unix_gid_to_PI_group()
+
 ## Mapping SSO to people names.  There's a lot of them but we only use
 ## this to find the ones with most usage so we can get away with only
 ## a few.
@@ -310,50 +350,74 @@ def TiB2bytes(nTi):
     """Convert Ti bytes to bytes"""
     return nTi * (1024 ** 4)
 
+## du filenames are PREFIX-du-YYYYmmddHHMM
+DU_FILENAME_RE = re.compile(r'^([^-]+)-du-(\d{4})(\d{2})(\d{2})(\d{2})(\d{2})$')
+
 def date_from_filename(fname, prefix):
-    fparts = fname.split("-")
-    if len(fparts) != 3 or fparts[0:2] != [prefix, 'du']:
+    match = DU_FILENAME_RE.match(fname)
+    if match is None or match.group(1) != prefix:
         raise RuntimeError("not an %s-du filename '%s'"
                            % (prefix, fname))
-    return datetime.datetime.strptime(fparts[2], '%Y%m%d%H%M')
+    try:
+        return datetime.datetime(*[int(x) for x in match.groups()[1:]])
+    except ValueError:
+        raise RuntimeError("invalid date in %s-du filename '%s'"
+                           % (prefix, fname))
+
+def read_du_dir(dir_path, prefix, read_timepoint):
+    """Read all du files in a directory.
+
+    Returns a dict, keys are datetime, values are whatever
+    read_timepoint returns for each file.  Files not starting with
+    PREFIX-du- are ignored, but those that do must be named like
+    PREFIX-du-YYYYmmddHHMM.  The files are on network mounts so they
+    are read in parallel.
+    """
+    with os.scandir(dir_path) as it:
+        entries = [e for e in it if e.name.startswith(prefix + '-du-')]
+    dates = [date_from_filename(e.name, prefix) for e in entries]
+    fpaths = [e.path for e in entries]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        return dict(zip(dates, executor.map(read_timepoint, fpaths)))
 
 
 class DU():
     def latest(self):
-        return self.du[sorted(self.du.keys())[-1]]
+        return self.du[max(self.du)]
 
     def over_time(self):
         """Returns a dict, keys are datetime, values are number of bytes.
         """
-        total_du = dict()
-        for date, timepoint in self.du.items():
-            total = 0
-            for users in timepoint.values():
-                total += sum(users.values())
-            total_du[date] = total
-        return total_du
+        return {date : sum(sum(users.values()) for users in timepoint.values())
+                for date, timepoint in self.du.items()}
 
-    def by_pi_group(self):
+    def by_pi_group_and_institute(self):
+        """Totals of the latest timepoint by PI group and by institute.
+
+        Both are computed in a single pass since they are always used
+        together.
+        """
         grp_map = self.gid_to_PIgroup()
 
-        totals = {g.pi_name : 0 for g in grp_map.values()}
+        by_pi = {g.pi_name : 0 for g in grp_map.values()}
+        by_inst = {g.affiliation : 0 for g in grp_map.values()}
         for gid, users in self.latest().items():
-            totals[grp_map[gid].pi_name] += sum(users.values())
-        return totals
+            grp = grp_map[gid]
+            nbytes = sum(users.values())
+            by_pi[grp.pi_name] += nbytes
+            by_inst[grp.affiliation] += nbytes
+        return (by_pi, by_inst)
 
-    def by_institute(self):
-        grp_map = self.gid_to_PIgroup()
+    def by_pi_group(self):
+        return self.by_pi_group_and_institute()[0]
 
-        totals = {g.affiliation : 0 for g in grp_map.values()}
-        for gid, users in self.latest().items():
-            totals[grp_map[gid].affiliation] += sum(users.values())
-        return totals
+    def by_institute(self):
+        return self.by_pi_group_and_institute()[1]
 
     def by_users(self):
-        totals = dict()
+        totals = collections.Counter()
         for users in self.latest().values():
-            for uid, nbytes in users.items():
-                totals[uid] = totals.get(uid, 0) + nbytes
+            totals.update(users)
         return totals
 
 
@@ -379,23 +443,19 @@ class OmeroDU(DU):
                 omero_user_id_6 : nbytes
                 omero_user_id_7 : nbytes
         """
-        omerodu = dict()
-        for fname in os.listdir(dir_path):
-            date = date_from_filename(fname, 'omero')
-            with open(os.path.join(dir_path, fname), 'r') as fh:
-                timepoint = json.load(fh)
-                ## convert the numeric ids from str to int
-                fixed_timepoint = dict()
-                for gid, users in timepoint.items():
-                    fixed_group = dict()
-                    for uid, nbytes in users.items():
-                        fixed_group[int(uid)] = nbytes
-                    fixed_timepoint[int(gid)] = fixed_group
-                omerodu[date] = fixed_timepoint
-        self.du = omerodu
+        self.du = read_du_dir(dir_path, 'omero', self.read_timepoint)
+
+    @staticmethod
+    def read_timepoint(fpath):
+        with open(fpath, 'rb') as fh:
+            timepoint = json_loads(fh.read())
+        ## convert the numeric ids from str to int
+        return {int(gid) : {int(uid) : nbytes
+                            for uid, nbytes in users.items()}
+                for gid, users in timepoint.items()}
 
     def gid_to_PIgroup(self):
-        return {grp.omero_gid : grp.payee for grp in OMERO_GROUPS.values()}
+        return OMERO_GID_TO_PI_GROUP
 
 
 class FSDU(DU):
@@ -413,79 +473,77 @@ class FSDU(DU):
           * users may have data in different groups.. However, we only
             have their primary group.
         """
-        du = dict()
-        for fname in os.listdir(dir_path):
-            date = date_from_filename(fname, 'micronusers')
-            timepoint = dict()
-            with open(os.path.join(dir_path, fname), 'r') as fh:
-                for line in fh:
-                    data = line.rstrip().split(' ')
-                    username = data[0]
-                    unix_gid = int(data[2])
-                    n_blocks = int(data[3])
-
-                    ## Richard Bryan won't pre-process the data so some
-                    ## users will appear in multiple lines.  We have to
-                    ## look for them and add it together.
-                    fs_group = timepoint.setdefault(unix_gid, dict())
-                    fs_group[username] = fs_group.get(username, 0) + n_blocks
-
-            du[date] = timepoint
-
-        ## A quota block is 1024 bytes (/usr/include/sys/mount.h)
-        for timepoint in du.values():
-            for fs_group in timepoint.values():
-                for username in fs_group.keys():
-                    fs_group[username] *= 1024 # convert blocks to bytes
-        self.du = du
+        self.du = read_du_dir(dir_path, 'micronusers', self.read_timepoint)
+
+    @staticmethod
+    def read_timepoint(fpath):
+        timepoint = collections.defaultdict(collections.Counter)
+        with open(fpath, 'r', buffering=128*1024) as fh:
+            for line in fh:
+                data = line.split()
+                username = data[0]
+                unix_gid = int(data[2])
+                ## A quota block is 1024 bytes (/usr/include/sys/mount.h)
+                nbytes = int(data[3]) * 1024
+
+                ## Richard Bryan won't pre-process the data so some
+                ## users will appear in multiple lines.  We have to
+                ## look for them and add it together.
+                timepoint[unix_gid][username] += nbytes
+        ## Back to plain dicts so that lookups of missing keys fail.
+        return {gid : dict(users) for gid, users in timepoint.items()}
 
     def gid_to_PIgroup(self):
-        grp_map = dict()
-        for grp in PI_GROUPS:
-            gid = grp.unix_gid
-            if not gid:
-                continue # guess this PI does not have a micron group
-            if grp_map.get(gid):
-                raise RuntimeError("found '%s' and '%s' with unix gid '%i'"
-                                   % (grp_map[gid], grp.pi_name, gid))
-            grp_map[gid] = grp
-        return grp_map
+        return UNIX_GID_TO_PI_GROUP
 
 def print_top_users(total_du, threshold=0):
-    total_du = {k:v for k,v in total_du.items() if v > threshold}
-    total_du = collections.OrderedDict(sorted(total_du.items(),
-                                              key=lambda t: t[1],
-                                              reverse=True))
-    for uid, nbytes in total_du.items():
-        print ("%6i GiB   %s (%s)"
-               % (bytes2GiB(nbytes), uid,USERNAMES.get(uid, uid)))
+    """Print users with more than threshold bytes, largest first."""
+    top = sorted(((k, v) for k, v in total_du.items() if v > threshold),
+                 key=lambda t: t[1], reverse=True)
+    sys.stdout.write(''.join("%6i GiB   %s (%s)\n"
+                             % (bytes2GiB(nbytes), uid, USERNAMES.get(uid, uid))
+                             for uid, nbytes in top))
 
 
-def plot_total_by_time(total_du, title="Total disk usage"):
+def save_figure(fig, save_path=None):
+    """Save figure to save_path and close it, if save_path is not None.
+
+    Otherwise the figure is left open to be shown later, together with
+    all other figures.
+    """
+    if save_path is not None:
+        fig.savefig(save_path)
+        matplotlib.pyplot.close(fig)
+
+
+def plot_total_by_time(total_du, title="Total disk usage", save_path=None):
     """Plot total disk usage over time.
 
     Parameters
     ----------
       total_du: dict
         keys should be datetime objects and values int with number of bytes.
+      save_path : string
+        file to save the plot to, instead of leaving it to be shown.
     """
 
     total_du = {date : bytes2TiB(du) for date, du in total_du.items()}
 
     fig, ax = matplotlib.pyplot.subplots()
-    ax.plot_date(*zip(*sorted(total_du.items())))
+    ax.plot(*zip(*sorted(total_du.items())), 'o')
 
     ## Only label the year but have ticks for every month.
     ax.xaxis.set_major_locator(matplotlib.dates.YearLocator())
     ax.xaxis.set_minor_locator(matplotlib.dates.MonthLocator())
     ax.xaxis.set_major_formatter(matplotlib.dates.DateFormatter('%Y'))
 
-    matplotlib.pyplot.title(title)
-    matplotlib.pyplot.ylabel("Disk Usage (TiB)")
-    matplotlib.pyplot.show()
+    ax.set_title(title)
+    ax.set_ylabel("Disk Usage (TiB)")
+    save_figure(fig, save_path)
 
 
-def plot_by_group(group_du, title="Disk usage by group", threshold=0):
+def plot_by_group(group_du, title="Disk usage by group", threshold=0,
+                  save_path=None):
     """
     Parameters
     ----------
@@ -495,60 +553,85 @@ def plot_by_group(group_du, title="Disk usage by group", threshold=0):
         title for the plot
       threshold : int
         Entries with less than this number of bytes will be ignored.
+      save_path : string
+        file to save the plot to, instead of leaving it to be shown.
     """
-    group_du = {k:bytes2TiB(v) for k,v in group_du.items() if v > threshold}
-
     ## Display sorted by group name
-    group_du = collections.OrderedDict(sorted(group_du.items(),
-                                              key=lambda t: t[0]))
-    label_pos = range(len(group_du))
+    items = sorted((k, bytes2TiB(v)) for k, v in group_du.items()
+                   if v > threshold)
+    labels = [k for k, v in items]
+    values = [v for k, v in items]
+    label_pos = range(len(items))
 
     fig, ax = matplotlib.pyplot.subplots()
-    ax.barh(label_pos, group_du.values(), align='center')
+    ax.barh(label_pos, values, align='center')
     ax.set_yticks(label_pos)
-    ax.set_yticklabels(list(group_du.keys()))
+    ax.set_yticklabels(labels)
 
     ax.invert_yaxis()  # labels read top-to-bottom
-    matplotlib.pyplot.title(title)
-    matplotlib.pyplot.xlabel("Disk Usage (TiB)")
-    matplotlib.pyplot.show()
+    ax.set_title(title)
+    ax.set_xlabel("Disk Usage (TiB)")
+    save_figure(fig, save_path)
 
 
 def main(argv):
     parser = argparse.ArgumentParser()
     parser.add_argument('--omero-data')
     parser.add_argument('--fs-data')
+    parser.add_argument('--save-dir',
+                        help='save the plots there instead of showing them')
     args = parser.parse_args(argv)
 
+    def save_path(fname):
+        if args.save_dir is None:
+            return None
+        return os.path.join(args.save_dir, fname)
+
+    if args.save_dir is not None:
+        ## Fail, or create it, before spending time reading the du files.
+        os.makedirs(args.save_dir, exist_ok=True)
+        ## Nothing is shown so there is no need for an interactive backend.
+        matplotlib.pyplot.switch_backend('Agg')
+
     if args.omero_data:
         omero_du = OmeroDU(args.omero_data)
         plot_total_by_time(omero_du.over_time(),
-                           title="OMERO disk usage")
+                           title="OMERO disk usage",
+                           save_path=save_path('omero-du.png'))
 
-        plot_by_group(omero_du.by_pi_group(),
+        by_pi, by_inst = omero_du.by_pi_group_and_institute()
+        plot_by_group(by_pi,
                       title="OMERO disk usage by PI group",
-                      threshold=TiB2bytes(1))
+                      threshold=TiB2bytes(1),
+                      save_path=save_path('omero-du-by-pi-group.png'))
 
-        plot_by_group(omero_du.by_institute(),
+        plot_by_group(by_inst,
                       title="OMERO disk usage by institute",
-                      threshold=TiB2bytes(1))
+                      threshold=TiB2bytes(1),
+                      save_path=save_path('omero-du-by-institute.png'))
 
     if args.fs_data:
         fs_du = FSDU(args.fs_data)
         plot_total_by_time(fs_du.over_time(),
-                           title="Micron ~ disk usage")
+                           title="Micron ~ disk usage",
+                           save_path=save_path('fs-du.png'))
 
-        plot_by_group(fs_du.by_pi_group(),
+        by_pi, by_inst = fs_du.by_pi_group_and_institute()
+        plot_by_group(by_pi,
                       title="Micron ~ disk usage by PI group",
-                      threshold=TiB2bytes(1))
+                      threshold=TiB2bytes(1),
+                      save_path=save_path('fs-du-by-pi-group.png'))
 
-        plot_by_group(fs_du.by_institute(),
+        plot_by_group(by_inst,
                       title="Micron ~ disk usage by institute",
-                      threshold=TiB2bytes(1))
+                      threshold=TiB2bytes(1),
+                      save_path=save_path('fs-du-by-institute.png'))
 
         users_totals = fs_du.by_users()
         print_top_users(users_totals, threshold=TiB2bytes(0.5))
 
+    if args.save_dir is None:
+        matplotlib.pyplot.show()
     return
 
 if __name__ == "__main__":
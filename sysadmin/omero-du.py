@@ -32,7 +32,6 @@ import json
 import sys
 
 import omero.gateway
-import omero.rtypes
 import omero.sys
 
 def omero_du(conn):
@@ -40,26 +39,25 @@ def omero_du(conn):
   params = omero.sys.ParametersI()
   params.theFilter = omero.sys.Filter()
 
-  def getBytes(ctx, eid):
-    params.add('eid', omero.rtypes.rlong(eid))
-    bytesInGroup = 0
-
-    pixelsQuery = "select sum(cast( p.sizeX as double ) * p.sizeY * p.sizeZ * p.sizeT * p.sizeC * pt.bitSize / 8) " \
-                  "from Pixels p join p.pixelsType as pt join p.image i left outer join i.fileset f " \
-                  "join p.details.owner as owner " \
-                  "where f is null and owner.id = (:eid)"
-
-    filesQuery = "select sum(origFile.size) from OriginalFile as origFile " \
-                 "join origFile.details.owner as owner where owner.id = (:eid)"
-
-    # Calculate disk usage via Pixels
-    result = queryService.projection(pixelsQuery, params, ctx)
-    if len(result) > 0 and len(result[0]) > 0:
-      bytesInGroup += result[0][0].val
-    # Now get Original File usage
-    result = queryService.projection(filesQuery, params, ctx)
-    if len(result) > 0 and len(result[0]) > 0:
-      bytesInGroup += result[0][0]._val
+  ## Both queries sum the usage of all owners in the group at once,
+  ## instead of two queries per experimenter.
+  pixelsQuery = "select owner.id, sum(cast( p.sizeX as double ) * p.sizeY * p.sizeZ * p.sizeT * p.sizeC * pt.bitSize / 8) " \
+                "from Pixels p join p.pixelsType as pt join p.image i left outer join i.fileset f " \
+                "join p.details.owner as owner " \
+                "where f is null group by owner.id"
+
+  filesQuery = "select owner.id, sum(origFile.size) from OriginalFile as origFile " \
+               "join origFile.details.owner as owner group by owner.id"
+
+  def getBytes(ctx, eids):
+    bytesInGroup = dict.fromkeys(eids, 0)
+    # Calculate disk usage via Pixels, and then Original File usage
+    for query in (pixelsQuery, filesQuery):
+      for row in queryService.projection(query, params, ctx):
+        eid = row[0].val
+        ## Only count the current members of the group.
+        if eid in bytesInGroup and row[1] is not None:
+          bytesInGroup[eid] += row[1].val
     return bytesInGroup
 
   sr = conn.getAdminService().getSecurityRoles()
@@ -76,10 +74,7 @@ def omero_du(conn):
     owners, experimenters = group.groupSummary()
 
     ctx = conn.SERVICE_OPTS.copy()
-    group_du = dict()
-    for e in owners + experimenters:
-      group_du[e.getId()] = getBytes(ctx, e.getId())
-    du[g.getId()] = group_du
+    du[g.getId()] = getBytes(ctx, [e.getId() for e in owners + experimenters])
   return du
 
 def main(argv):
@@ -104,7 +99,7 @@ def main(argv):
     raise RuntimeError("Failed to connect to OMERO server")
 
   du = omero_du(conn)
-  print json.dumps(du)
+  sys.stdout.write(json.dumps(du) + "\n")
 
 if __name__ == "__main__":
   main(sys.argv[1:])
@@ -9,15 +9,37 @@
 # imports
 
 from Pyro.ext import remote_nons as r
+import threading
 import time
 from prometheus_client import start_http_server, Gauge
 
-#definitions of the Pyro object connections to be made
-POBJS=[["cabinettemperature","ni","omxnano",7766],
- ["Cam1temperature","pyroCam","omxcam1",1840],
- ["Cam2temperature","pyroCam","omxcam2",1840],
- ["Cam3temperature","pyroCam","omxcam3",1840],
- ["Cam4temperature","pyroCam","omxcam4",1840]]
+#definitions of the Pyro object connections to be made, and the
+#function that returns the temperature.  Ni function is getTemp,
+#cameras use getTemperature.
+POBJS=[["cabinettemperature","ni","omxnano",7766,"getTemp"],
+ ["Cam1temperature","pyroCam","omxcam1",1840,"getTemperature"],
+ ["Cam2temperature","pyroCam","omxcam2",1840,"getTemperature"],
+ ["Cam3temperature","pyroCam","omxcam3",1840,"getTemperature"],
+ ["Cam4temperature","pyroCam","omxcam4",1840,"getTemperature"]]
+
+
+def poll(gauge, pyroName, host, port, getTempName):
+    #Each remote is polled in its own thread, with its own
+    #connection, so that a slow or dead remote does not hold back
+    #the others.
+    con=None
+    while True:
+        try:
+            if con is None:
+                con=r.get_server_object(pyroName,host,port)
+            gauge.set(getattr(con,getTempName)())
+        except Exception as e:
+            print ("failed to get %s from %s: %s" % (pyroName,host,e))
+            #Do not report an old value and reconnect next time.
+            gauge.set(float('nan'))
+            con=None
+        #Sleep as we don't need too much resolution.
+        time.sleep(10)
 
 
 if __name__ == '__main__':
@@ -25,21 +47,13 @@ if __name__ == '__main__':
     # Start up the server to expose the metrics.
     start_http_server(8000)
 
-    #initiallise pyro connections
-    cons=[None]*len(POBJS)
-    consTemps=[None]*len(POBJS)
-    for i in range (len(POBJS)):
- #       print (i,POBJS[i])
-        cons[i]=r.get_server_object(POBJS[i][1],POBJS[i][2],POBJS[i][3])
-        consTemps[i]=Gauge(POBJS[i][0],POBJS[i][0])
-    
-    while True:
-        # Ni function is getTemp
-        consTemps[0].set(cons[0].getTemp())
-		#Cameras use getTempearture
-        for i in range (4):
-            consTemps[i+1].set(cons[i+1].getTemperature())
-		#Sleep as we don't need too much resolution.
-        time.sleep(10)
-
+    #start polling each of the remotes
+    for pobj in POBJS:
+        gauge=Gauge(pobj[0],pobj[0])
+        thread=threading.Thread(target=poll,args=[gauge]+pobj[1:])
+        thread.daemon=True
+        thread.start()
 
+    #the polling threads do all the work
+    while True:
+        time.sleep(60)